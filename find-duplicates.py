@@ -1,116 +1,214 @@
 import argparse
+import filecmp
 import hashlib
 import logging
+import mmap
 import os
 from collections import defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor
+
+try:
+    # much faster than hashlib on large files, and releases the GIL while hashing
+    from blake3 import blake3 as default_hash
+except ImportError:
+    default_hash = hashlib.sha256
+
+
+# Block size for whole-file reads, large enough to amortise the read syscalls
+READ_BLOCK_SIZE = 1024 * 1024
 
 
 def chunk_reader(fd, chunk_size):
-    """Generator that reads a file in chunks of bytes"""
+    """Generator that reads a file in chunks of bytes, reusing a single buffer"""
+    buffer = bytearray(chunk_size)
+    view = memoryview(buffer)
     while True:
-        chunk = fd.read(chunk_size)
-        if not chunk:
+        size = fd.readinto(buffer)
+        if not size:
             return
-        yield chunk
+        yield view[:size]
 
 
-def get_hash(filename, chunk_size, first_chunk_only=False, hash=hashlib.sha1):
-    hashobj = hash()
-    file_object = open(filename, 'rb')
+def read_chunk(fd, chunk_size):
+    """Reads up to chunk_size bytes, stopping short only at the end of the file"""
+    buffer = bytearray(chunk_size)
+    view = memoryview(buffer)
+    size = 0
+    while size < chunk_size:
+        read = fd.readinto(view[size:])
+        if not read:
+            break
+        size += read
+    return view[:size]
 
-    if first_chunk_only:
-        hashobj.update(file_object.read(chunk_size))
-    else:
-        for chunk in chunk_reader(file_object, chunk_size):
+
+def hash_chunks(hashobj, fd, file_size):
+    """Feeds a file into hashobj block by block"""
+    if hasattr(os, 'posix_fadvise'):
+        # let the kernel read ahead aggressively
+        os.posix_fadvise(fd.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+    # no need for a full block on small files, but keep at least a byte to read into
+    for chunk in chunk_reader(fd, min(READ_BLOCK_SIZE, max(file_size, 1))):
+        hashobj.update(chunk)
+
+
+def get_hash(filename, chunk_size, first_chunk_only=False, hash=default_hash, file_size=None):
+    hashobj = hash()
+    with open(filename, 'rb', buffering=0) as file_object:
+        if first_chunk_only:
+            # unbuffered reads may return short, so read_chunk keeps reading until the chunk is full
+            if file_size is not None and file_size <= chunk_size:
+                # the chunk will be trusted as the whole file, so read one byte past
+                # the scanned size to make sure the file hasn't changed since
+                chunk = read_chunk(file_object, file_size + 1)
+                if len(chunk) != file_size:
+                    raise OSError(
+                        f'File changed size since it was scanned: {filename}')
+            else:
+                chunk = read_chunk(file_object, chunk_size)
             hashobj.update(chunk)
-    file_hash = hashobj.digest()
+        else:
+            st_size = os.fstat(file_object.fileno()).st_size
+            mm = None
+            if st_size > chunk_size:
+                try:
+                    # hash straight from the page cache without copying into Python objects
+                    mm = mmap.mmap(file_object.fileno(), 0,
+                                   access=mmap.ACCESS_READ)
+                except (OSError, ValueError):
+                    pass
+            if mm is not None:
+                with mm:
+                    if hasattr(mmap, 'MADV_SEQUENTIAL'):
+                        mm.madvise(mmap.MADV_SEQUENTIAL)
+                    hashobj.update(mm)
+            else:
+                hash_chunks(hashobj, file_object, st_size)
+    return hashobj.digest()
+
+
+def get_full_hashes(files, chunk_size, hash=default_hash):
+    """Hashes each file in full, returning a list of (full_hash, filename)"""
+    full_hashes = []
+    for filename in files:
+        try:
+            full_hashes.append(
+                (get_hash(filename, chunk_size, first_chunk_only=False, hash=hash), filename))
+        except (OSError,):
+            logger.warning(f'Error reading file: {filename}')
+            continue
+    return full_hashes
 
-    file_object.close()
-    return file_hash
+
+def find_group_duplicates(files, chunk_size, hash=default_hash):
+    """Returns (original, duplicate) pairs among files of the same size and first chunk"""
+    if len(files) == 2:
+        # a byte comparison stops at the first difference instead of hashing both files in full
+        try:
+            if filecmp.cmp(files[0], files[1], shallow=False):
+                return [(files[0], files[1])]
+        except (OSError,) as e:
+            logger.warning(f'Error reading file: {e.filename}')
+        return []
+
+    hashes_full = {}   # dict of full_file_hash: full_path_to_file_string
+    pairs = []
+    for full_hash, filename in get_full_hashes(files, chunk_size, hash):
+        duplicate = hashes_full.get(full_hash)
+        if duplicate:
+            pairs.append((duplicate, filename))
+        else:
+            hashes_full[full_hash] = filename
+    return pairs
 
 
-def check_for_duplicates(path, chunk_size, recursive, hash=hashlib.sha1):
+def scan_file_sizes(path, recursive):
+    """Generator that yields (full_path, size_in_bytes) for files in path, reusing the directory scan's stat"""
+    try:
+        entries = list(os.scandir(path))
+    except (OSError,):
+        logger.warning(f'Error reading directory: {path}')
+        return
+    for entry in entries:
+        try:
+            if entry.is_dir(follow_symlinks=False):
+                if recursive:
+                    yield from scan_file_sizes(entry.path, recursive)
+                continue
+            if not entry.is_file():
+                continue
+            # if the target is a symlink (soft one), this will
+            # dereference it - change the value to the actual target file
+            full_path = entry.path
+            if entry.is_symlink():
+                full_path = os.path.realpath(full_path)
+            file_size = entry.stat().st_size
+        except (OSError,):
+            # not accessible (permissions, etc) - pass on
+            logger.warning(f'Error reading file: {entry.path}')
+            continue
+        yield full_path, file_size
+
+
+def check_for_duplicates(path, chunk_size, recursive, hash=default_hash):
     # dict of size_in_bytes: [full_path_to_file1, full_path_to_file2, ]
     hashes_by_size = defaultdict(list)
-    # dict of (hash1k, size_in_bytes): [full_path_to_file1, full_path_to_file2, ]
-    hashes_on_1k = defaultdict(list)
-    hashes_full = {}   # dict of full_file_hash: full_path_to_file_string
     duplicates = defaultdict(set)
 
     logger.info('Comparing file sizes')
 
-    if not recursive:
-        for filename in os.listdir(path):
-            try:
-                full_path = os.path.realpath(os.path.join(path, filename))
-                if os.path.isfile(full_path):
-                    file_size = os.path.getsize(full_path)
-                    hashes_by_size[file_size].append(full_path)
-            except (OSError,):
-                # not accessible (permissions, etc) - pass on
-                logger.warning(
-                    f'Error reading file: {os.path.join(path, filename)}')
-                continue
-    else:
-        for dirpath, dirnames, filenames in os.walk(path):
-            # get all files that have the same size - they are the collision candidates
-            for filename in filenames:
-                full_path = os.path.join(dirpath, filename)
+    # get all files that have the same size - they are the collision candidates
+    for full_path, file_size in scan_file_sizes(os.path.realpath(path), recursive):
+        hashes_by_size[file_size].append(full_path)
+
+    logger.info('Comparing hashes')
+
+    # For all files with the same file size, group them by the hash of their 1st chunk, then compare
+    # the full contents of each group right away - matches will be duplicates
+    # hashing releases the GIL, so groups are compared concurrently while later sizes are still being grouped
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        group_duplicates = []
+        for size_in_bytes, files in hashes_by_size.items():
+            if len(files) < 2:
+                continue    # this file size is unique, no need to spend CPU cycles on it
+
+            # dict of hash1k: [full_path_to_file1, full_path_to_file2, ]
+            # the files already share a size, so the hash on the first chunk
+            # is enough to avoid collisions (credits to @Futal for the optimization)
+            hashes_on_1k = defaultdict(list)
+            for filename in files:
                 try:
-                    # if the target is a symlink (soft one), this will
-                    # dereference it - change the value to the actual target file
-                    full_path = os.path.realpath(full_path)
-                    file_size = os.path.getsize(full_path)
-                    hashes_by_size[file_size].append(full_path)
+                    small_hash = get_hash(filename, chunk_size, first_chunk_only=True,
+                                          hash=hash, file_size=size_in_bytes)
+                    hashes_on_1k[small_hash].append(filename)
                 except (OSError,):
-                    # not accessible (permissions, etc) - pass on
-                    logger.warning(
-                        f'Error reading file: {os.path.join(dirpath, filename)}')
+                    # the file access might've changed till the exec point got here
+                    logger.warning(f'Error reading file: {filename}')
                     continue
 
-    logger.info('Comparing short hashes')
-
-    # For all files with the same file size, get their hash on the 1st chunk only
-    for size_in_bytes, files in hashes_by_size.items():
-        if len(files) < 2:
-            continue    # this file size is unique, no need to spend CPU cycles on it
-
-        for filename in files:
-            try:
-                small_hash = get_hash(
-                    filename, chunk_size, first_chunk_only=True)
-                # the key is the hash on the first chunk plus the size - to
-                # avoid collisions on equal hashes in the first part of the file
-                # credits to @Futal for the optimization
-                hashes_on_1k[(small_hash, size_in_bytes)].append(filename)
-            except (OSError,):
-                # the file access might've changed till the exec point got here
-                logger.warning(
-                    f'Error reading file: {os.path.join(path, filename)}')
-                continue
+            for files_list in hashes_on_1k.values():
+                if len(files_list) < 2:
+                    continue    # this hash of fist 1k file bytes is unique, no need to spend CPU cycles on it
 
-    logger.info('Comparing full hashes')
-
-    # For all files with the same hash on the 1st chunk, get their hash on the full file - collisions will be duplicates
-    for __, files_list in hashes_on_1k.items():
-        if len(files_list) < 2:
-            continue    # this hash of fist 1k file bytes is unique, no need to spend CPU cycles on it
-
-        for filename in files_list:
-            try:
-                full_hash = get_hash(filename, chunk_size,
-                                     first_chunk_only=False)
-                duplicate = hashes_full.get(full_hash)
-                if duplicate:
-                    logger.info(
-                        f'Duplicate: {os.path.basename(duplicate)} | {os.path.basename(filename)}')
-                    duplicates[duplicate].add(filename)
+                if size_in_bytes <= chunk_size:
+                    # the first chunk covered the whole file, no need to read it again
+                    group_duplicates.append(
+                        [(files_list[0], f) for f in files_list[1:]])
                 else:
-                    hashes_full[full_hash] = filename
-            except (OSError,):
-                logger.warning(
-                    f'Error reading file: {os.path.join(dirpath, filename)}')
-                continue
+                    group_duplicates.append(executor.submit(
+                        find_group_duplicates, files_list, chunk_size, hash))
+
+        # merge on the main thread so the dict needs no locking
+        basenames = {}  # dict of full_path_to_file: basename, for files with duplicates
+        for pairs in group_duplicates:
+            if isinstance(pairs, Future):
+                pairs = pairs.result()
+            for duplicate, filename in pairs:
+                if duplicate not in basenames:
+                    basenames[duplicate] = os.path.basename(duplicate)
+                logger.info(
+                    f'Duplicate: {basenames[duplicate]} | {os.path.basename(filename)}')
+                duplicates[duplicate].add(filename)
     return duplicates
 
 
@@ -127,13 +225,10 @@ def single_yes_or_no_question(question, default_no=True):
 
 
 def find_keep_file(files):
-    filename_files_dict = {os.path.splitext(os.path.basename(f))[
-        0]: i for i, f in enumerate(files)}
-    filenames = list(filename_files_dict.keys())
-    filenames.sort()
-    filenames.sort(key=len)
-    keep_file_idx = filename_files_dict[filenames[0]]
-    return files[keep_file_idx]
+    def shortest_then_earliest(f):
+        filename = os.path.splitext(os.path.basename(f))[0]
+        return len(filename), filename
+    return min(files, key=shortest_then_earliest)
 
 
 def main(path, chunk_size, recursive, force, dry_run):
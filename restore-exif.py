@@ -1,53 +1,192 @@
 import argparse
+import functools
 import logging
 import os
-import re
+import struct
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 
 import piexif
 
-img_filename_regex = re.compile(r'IMG-\d{8}-WA\d{4}\..+')
-vid_filename_regex = re.compile(r'VID-\d{8}-WA\d{4}\..+')
+
+@functools.lru_cache(maxsize=4096)
+def parse_date(date_str):
+    # many files share a date, and strptime is slow
+    return datetime.strptime(date_str, '%Y%m%d')
 
 
 def get_datetime(filename):
     date_str = filename.split('-')[1]
-    return datetime.strptime(date_str, '%Y%m%d')
+    return parse_date(date_str)
 
 
-def get_exif_datestr(filename):
-    return get_datetime(filename).strftime("%Y:%m:%d %H:%M:%S")
+def get_exif_datestr(date):
+    return date.strftime("%Y:%m:%d %H:%M:%S")
 
 
 def get_filepaths(path, recursive):
-    all_filepaths = []
-    if not recursive:
-        abspath = os.path.abspath(path)
-        all_filepaths += [(abspath, f) for f in os.listdir(abspath)
-                          if os.path.isfile(os.path.join(abspath, f))]
-    else:
-        for dirpath, dirnames, filenames in os.walk(path):
-            abspath = os.path.abspath(dirpath)
-            all_filepaths += [(abspath, f) for f in filenames]
-    return all_filepaths
+    """Generator that yields (abspath, filename) for files in path, walking it top-down"""
+    abspath = os.path.abspath(path)
+    subdirs = []
+    try:
+        with os.scandir(abspath) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_file():
+                        yield abspath, entry.name
+                    elif recursive and entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.path)
+                except (OSError,):
+                    # not accessible (permissions, etc) - pass on
+                    logger.warning(f'Error reading file: {entry.path}')
+                    continue
+    except (OSError,):
+        logger.warning(f'Error reading directory: {abspath}')
+    for subdir in subdirs:
+        yield from get_filepaths(subdir, recursive)
 
 
 def filter_filepaths(filepaths, allowed_ext):
-    return [(fp, fn) for fp, fn in filepaths if os.path.splitext(fn)[-1] in allowed_ext]
+    # endswith takes a tuple of suffixes and checks them all in C
+    return ((fp, fn) for fp, fn in filepaths if fn.endswith(allowed_ext))
+
+
+# Exif block with just DateTimeOriginal, the date string follows at the end:
+# TIFF header, IFD0 pointing to the Exif IFD, Exif IFD with the 20 byte date string
+EXIF_TEMPLATE = (b'Exif\x00\x00' + b'MM\x00\x2a' + struct.pack('>I', 8)
+                 + struct.pack('>HHHIII', 1, piexif.ImageIFD.ExifTag, 4, 1, 26, 0)
+                 + struct.pack('>HHHIII', 1, piexif.ExifIFD.DateTimeOriginal, 2, 20, 44, 0))
+
+
+def make_new_exif(exif_datestr):
+    return EXIF_TEMPLATE + exif_datestr.encode('ascii') + b'\x00'
+
+
+def find_exif_segment(file_object):
+    """Returns the (offset, length) of a JPEG's Exif APP1 segment, or None if it has none"""
+    if file_object.read(2) != b'\xff\xd8':
+        raise ValueError('Missing JPEG SOI marker')
+    offset = 2
+    while True:
+        header = file_object.read(4)
+        if len(header) < 4 or header[0] != 0xff:
+            raise ValueError(f'Invalid JPEG marker at offset {offset}')
+        marker = header[1]
+        if marker in (0xd9, 0xda):
+            # reached EOI or the start of the image data
+            return None
+        length = int.from_bytes(header[2:], 'big') + 2
+        if marker == 0xe1 and file_object.read(6) == b'Exif\x00\x00':
+            return offset, length
+        offset += length
+        file_object.seek(offset)
+
+
+def has_exif(filepath):
+    """Checks for an Exif segment without parsing it, erring on the side of True"""
+    with open(filepath, 'rb') as f:
+        try:
+            return find_exif_segment(f) is not None
+        except ValueError:
+            # let piexif work out what is wrong with the file
+            return True
+
 
+def find_exif_position(file_object):
+    """Returns the (offset, length) to write a JPEG's Exif segment at, replacing any existing one"""
+    segment = find_exif_segment(file_object)
+    if segment is not None:
+        return segment
+    # new segments go right after SOI, or after the JFIF APP0 segment which must come first.
+    # Unlike piexif.insert, which replaces or drops APP0, the JFIF segment is kept
+    file_object.seek(2)
+    header = file_object.read(4)
+    offset = 2
+    if header[:2] == b'\xff\xe0':
+        offset += int.from_bytes(header[2:], 'big') + 2
+    return offset, 0
 
-def make_new_exif(filename):
-    exif_dict = {
-        'Exif': {piexif.ExifIFD.DateTimeOriginal: get_exif_datestr(filename)}}
-    return piexif.dump(exif_dict)
 
+def write_exif(exif_bytes, filepath):
+    """Writes exif_bytes into a JPEG as its Exif segment, in place when the size is unchanged"""
+    # the segment also holds the 2 byte marker and 2 byte length
+    segment_bytes = b'\xff\xe1' + \
+        (len(exif_bytes) + 2).to_bytes(2, 'big') + exif_bytes
+    with open(filepath, 'r+b') as f:
+        try:
+            offset, length = find_exif_position(f)
+        except ValueError:
+            pass
+        else:
+            if length != len(segment_bytes):
+                # shift the rest of the file to fit the new segment
+                f.seek(offset + length)
+                image_data = f.read()
+                f.seek(offset)
+                f.write(segment_bytes)
+                f.write(image_data)
+                f.truncate()
+            else:
+                f.seek(offset)
+                f.write(segment_bytes)
+            return
+    # the markers could not be followed, let piexif deal with the file
+    piexif.insert(exif_bytes, filepath)
 
-def is_whatsapp_img(filename):
-    return bool(img_filename_regex.match(filename))
 
+def get_whatsapp_media_type(filename):
+    """Returns 'IMG' or 'VID' for filenames like IMG-YYYYMMDD-WANNNN.ext, otherwise None"""
+    media_type = filename[:3]
+    if (media_type in ('IMG', 'VID') and filename[3:4] == '-'
+            and filename[4:12].isdecimal() and filename[12:15] == '-WA'
+            and filename[15:19].isdecimal() and filename[19:20] == '.'
+            and len(filename) > 20):
+        return media_type
+    return None
 
-def is_whatsapp_vid(filename):
-    return bool(vid_filename_regex.match(filename))
+
+def get_mtime_ns(date):
+    # go through whole microseconds, a float of nanoseconds since the epoch loses precision
+    return int(date.timestamp() * 1e6) * 1000
+
+
+def process_image(task, mod, force):
+    """Restores the Exif date of a single (path, filename), returning (level, message) pairs to log"""
+    path, filename = task
+    filepath = os.path.join(path, filename)
+    messages = []
+    if get_whatsapp_media_type(filename) != 'IMG':
+        messages.append(
+            (logging.WARNING, 'File is not a valid WhatsApp image, skipping'))
+        return messages
+
+    date = get_datetime(filename)
+    exif_datestr = get_exif_datestr(date)
+    if not has_exif(filepath):
+        # nothing to preserve, skip parsing with piexif
+        exif_bytes = make_new_exif(exif_datestr)
+    else:
+        try:
+            exif_dict = piexif.load(filepath)
+            if exif_dict['Exif'].get(piexif.ExifIFD.DateTimeOriginal) and not force:
+                messages.append(
+                    (logging.INFO, 'Exif date already exists, skipping'))
+                return messages
+
+            exif_dict['Exif'][piexif.ExifIFD.DateTimeOriginal] = exif_datestr
+            exif_bytes = piexif.dump(exif_dict)
+        except piexif.InvalidImageDataError:
+            messages.append((logging.WARNING, 'Invalid image data, skipping'))
+            return messages
+        except ValueError:
+            messages.append(
+                (logging.WARNING, 'Invalid exif, overwriting with new exif'))
+            exif_bytes = make_new_exif(exif_datestr)
+    write_exif(exif_bytes, filepath)
+    if mod:
+        mtime_ns = get_mtime_ns(date)
+        os.utime(filepath, ns=(mtime_ns, mtime_ns))
+    return messages
 
 
 def main(path, recursive, mod, force):
@@ -58,58 +197,48 @@ def main(path, recursive, mod, force):
     if not os.path.isdir(path):
         raise TypeError('Path specified is not a directory')
 
-    logger.info('Listing files in target directory')
-    filepaths = get_filepaths(path, recursive)
-    # print(filepaths)
-    logger.info(f'Total files: {len(filepaths)}')
-
-    allowed_extensions = set(['.mp4', '.jpg', '.3gp', '.jpeg'])
-    logger.info(f'Filtering for valid file extensions: {allowed_extensions}')
-    filepaths = filter_filepaths(filepaths, allowed_ext=allowed_extensions)
+    allowed_extensions = ('.mp4', '.jpg', '.3gp', '.jpeg')
+    logger.info(
+        f'Listing files in target directory with valid file extensions: {allowed_extensions}')
+    filepaths = list(filter_filepaths(
+        get_filepaths(path, recursive), allowed_ext=allowed_extensions))
     num_files = len(filepaths)
     logger.info(f'Valid files: {num_files}')
 
+    video_filepaths = [(fp, fn) for fp, fn in filepaths
+                       if fn.endswith(('.mp4', '.3gp'))]
+    img_filepaths = [(fp, fn) for fp, fn in filepaths
+                     if fn.endswith(('.jpg', '.jpeg'))]
+
     logger.info('Begin processing files')
     abspath = os.path.abspath(path)
     progress_digits = len(str(num_files))
     abspath_len = len(abspath) + 1
-    for i, (path, filename) in enumerate(filepaths):
-        filepath = os.path.join(path, filename)
-        logger.info(
-            f'{i + 1:>{progress_digits}}/{num_files} - {filepath[abspath_len:]}')
-        if filename.endswith('.mp4') or filename.endswith('.3gp'):
-            if not is_whatsapp_vid(filename):
-                logger.warning('File is not a valid WhatsApp video, skipping')
-                continue
-            date = get_datetime(filename)
-            modTime = date.timestamp()
-            os.utime(filepath, (modTime, modTime))
+    # images are independent, so process them in parallel and log in order as results arrive
+    with ProcessPoolExecutor() as executor:
+        results = executor.map(functools.partial(process_image, mod=mod, force=force),
+                               img_filepaths, chunksize=64)
 
-        elif filename.endswith('.jpg') or filename.endswith('.jpeg'):
-            if not is_whatsapp_img(filename):
-                logger.warning('File is not a valid WhatsApp image, skipping')
+        # videos only need their modified date set, so collect those here while the images are processed
+        pending_mtimes = []  # list of (filepath, mtime_ns)
+        for i, (path, filename) in enumerate(video_filepaths):
+            filepath = os.path.join(path, filename)
+            logger.info(
+                f'{i + 1:>{progress_digits}}/{num_files} - {filepath[abspath_len:]}')
+            if get_whatsapp_media_type(filename) != 'VID':
+                logger.warning('File is not a valid WhatsApp video, skipping')
                 continue
+            pending_mtimes.append(
+                (filepath, get_mtime_ns(get_datetime(filename))))
+        for filepath, mtime_ns in pending_mtimes:
+            os.utime(filepath, ns=(mtime_ns, mtime_ns))
 
-            try:
-                exif_dict = piexif.load(filepath)
-                if exif_dict['Exif'].get(piexif.ExifIFD.DateTimeOriginal) and not force:
-                    logger.info('Exif date already exists, skipping')
-                    continue
-
-                exif_dict['Exif'][piexif.ExifIFD.DateTimeOriginal] = get_exif_datestr(
-                    filename)
-                exif_bytes = piexif.dump(exif_dict)
-            except piexif.InvalidImageDataError:
-                logger.warning(f'Invalid image data, skipping')
-                continue
-            except ValueError:
-                logger.warning(f'Invalid exif, overwriting with new exif')
-                make_new_exif(filename)
-            piexif.insert(exif_bytes, filepath)
-            if mod:
-                date = get_datetime(filename)
-                modTime = date.timestamp()
-                os.utime(filepath, (modTime, modTime))
+        for i, ((path, filename), messages) in enumerate(zip(img_filepaths, results), len(video_filepaths)):
+            filepath = os.path.join(path, filename)
+            logger.info(
+                f'{i + 1:>{progress_digits}}/{num_files} - {filepath[abspath_len:]}')
+            for level, message in messages:
+                logger.log(level, message)
 
     logger.info('Finished processing files')
 